@@ -1,10 +1,60 @@
-import requests
+import asyncio
+import contextlib
+import httpx
 import time
-import json
+import ijson
 import os
+import random
+import signal
 from datetime import datetime, timedelta
-from influxdb_client import InfluxDBClient, Point, WriteOptions
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import WritePrecision
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+_EPOCH = datetime(1970, 1, 1)
+_FIELD_KEY_ESCAPES = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ '})
+
+def _parse_ymd(date):
+    """
+    Parse a YYYY-MM-DD date string into a datetime
+    """
+    return datetime.fromisoformat(date)
+
+def _format_field_value(value):
+    """
+    Format a metric value as an InfluxDB line protocol field value
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _to_line_protocol(timestamp, metrics):
+    """
+    Build a daily_metrics line protocol record (second precision), or None if there are no fields
+    """
+    fields = ",".join(
+        f"{name.translate(_FIELD_KEY_ESCAPES)}={_format_field_value(value)}"
+        for name, value in metrics.items()
+        if value is not None  # Skip null values
+    )
+    if not fields:
+        return None
+    return f"daily_metrics {fields} {(timestamp - _EPOCH) // timedelta(seconds=1)}"
+
+def _contiguous_day_ranges(timestamps):
+    """
+    Group day timestamps into (start, stop) ranges of consecutive days, with stop exclusive
+    """
+    ranges = []
+    for timestamp in sorted(timestamps):
+        if ranges and timestamp <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], timestamp + timedelta(days=1))
+        else:
+            ranges.append([timestamp, timestamp + timedelta(days=1)])
+    return [(start, stop) for start, stop in ranges]
 
 class APIPoller:
     def __init__(self):
@@ -15,6 +65,11 @@ class APIPoller:
         self.api_base_url = os.environ.get('API_URL', 'https://ops.ultrahuman.com/api/web_dashboard/daily_trend')
         self.api_token = os.environ.get('API_TOKEN')
         
+        # API URL only changes when the date rolls over, so build it from a template and cache it
+        self._url_template = f"{self.api_base_url}/?&start_date={{s}}&end_date={{e}}"
+        self._cached_url = None
+        self._cached_url_day = None
+        
         # Optional environment variables with defaults
         self.debug_mode = os.environ.get('DEBUG_MODE', 'false').lower() == 'true'
         
@@ -24,68 +79,63 @@ class APIPoller:
         
         self.headers = {
             'Authorization': f'{self.api_token}',
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip, br'
         }
         
-        # Initialize InfluxDB client if environment variables are present
+        # API and InfluxDB clients are opened on the event loop in _run()
+        self.session = None
+        self.influx_client = None
+        
+        # Enable InfluxDB storage if environment variables are present
         self.influx_url = os.environ.get('INFLUX_URL')
         self.influx_token = os.environ.get('INFLUX_TOKEN')
         self.influx_org = os.environ.get('INFLUX_ORG')
         self.influx_bucket = os.environ.get('INFLUX_BUCKET')
         
-        if all([self.influx_url, self.influx_token, self.influx_org, self.influx_bucket]):
-            self.influx_client = InfluxDBClient(
-                url=self.influx_url,
-                token=self.influx_token,
-                org=self.influx_org
-            )
-            # Configure write API with write options
-            write_options = WriteOptions(
-                batch_size=1,
-                flush_interval=1_000,
-                write_type=SYNCHRONOUS
-            )
-            self.write_api = self.influx_client.write_api(write_options=write_options)
-            
-            # Delete API for handling overwrites
-            self.delete_api = self.influx_client.delete_api()
-        else:
-            self.influx_client = None
-            if self.debug_mode:
-                print("InfluxDB configuration incomplete - running in debug mode only")
+        self.influx_enabled = all([self.influx_url, self.influx_token, self.influx_org, self.influx_bucket])
+        if not self.influx_enabled and self.debug_mode:
+            print("InfluxDB configuration incomplete - running in debug mode only")
 
-    def get_yesterday_date(self):
+    def get_api_url(self):
         """
-        Get yesterday's date in YYYY-MM-DD format
+        Return the API URL covering yesterday to today, rebuilding it only when the date changes
         """
-        yesterday = datetime.now() - timedelta(days=1)
-        return yesterday.strftime('%Y-%m-%d')
+        today = datetime.now().date()
+        if today != self._cached_url_day:
+            yesterday = today - timedelta(days=1)
+            self._cached_url = self._url_template.format(s=yesterday.isoformat(), e=today.isoformat())
+            self._cached_url_day = today
+        return self._cached_url
 
-    def get_api_url(self):
+    def _get_daily_data(self, data):
         """
-        Generate API URL with yesterday's date for both start and end date
+        Return the daily_data mapping from an API response, or None if it is missing or empty
         """
-        yesterday = self.get_yesterday_date()
-        return f"{self.api_base_url}/?&start_date={yesterday}&end_date={datetime.now().strftime('%Y-%m-%d')}"
+        daily_data = (data.get('data') or {}).get('daily_data')
+        if not daily_data:
+            print("No daily data found in API response")
+            return None
+        return daily_data
 
     def print_debug_data(self, data):
         """
         Print data in InfluxDB line protocol format for debugging
         """
-        if 'data' not in data or 'daily_data' not in data['data']:
-            print("No daily data found in API response")
+        daily_data = self._get_daily_data(data)
+        if not daily_data:
             return
 
-        daily_data = data['data']['daily_data']
+        # Calculate the longest metric name across all dates once for alignment
+        max_key_length = max((len(key) for metrics in daily_data.values() for key in metrics), default=0)
+        
         print("\nData to be stored in InfluxDB:")
         print("-" * 50)
         for date, metrics in daily_data.items():
-            timestamp = datetime.strptime(date, "%Y-%m-%d")
+            timestamp = _parse_ymd(date)
             print(f"\nMeasurement: daily_metrics")
             print(f"Timestamp  : {timestamp}")
             print("Fields     :")
-            # Calculate the longest metric name for alignment
-            max_key_length = max(len(key) for key in metrics.keys())
             for metric_name, metric_value in metrics.items():
                 if metric_value is not None:  # Skip null values
                     # Right-align values for better readability
@@ -95,7 +145,7 @@ class APIPoller:
                         print(f"  {metric_name:<{max_key_length}} = {metric_value}")
         print("-" * 50)
 
-    def poll_api(self):
+    async def poll_api(self):
         """
         Poll the API and return JSON response
         """
@@ -104,23 +154,44 @@ class APIPoller:
             if self.debug_mode:
                 print(f"\nPolling URL: {api_url}")
             
-            response = requests.get(api_url, headers=self.headers)
-            response.raise_for_status()
+            async with self.session.stream('GET', api_url) as response:
+                if not response.is_success:
+                    await response.aread()  # Keep the error body available for debugging
+                response.raise_for_status()
+                
+                # Fail fast on non-JSON bodies such as HTML captcha pages
+                content_type = response.headers.get('Content-Type', '')
+                if 'json' not in content_type:
+                    raise ValueError(f"Unexpected content-type {content_type!r}")
+                
+                if self.debug_mode:
+                    print(f"Response encoding: {response.headers.get('Content-Encoding', 'identity')}")
+                
+                # Stream only the daily_data object out of the body instead of loading the whole document
+                items = ijson.sendable_list()
+                parser = ijson.kvitems_coro(items, 'data.daily_data', use_float=True)
+                async for chunk in response.aiter_bytes():
+                    parser.send(chunk)
+                parser.close()
+                daily_data = dict(items)
             
-            data = response.json()
+            data = {'data': {'daily_data': daily_data}}
             
             if self.debug_mode:
                 self.print_debug_data(data)
             
             return data
             
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"Error polling API: {e}")
-            if self.debug_mode and hasattr(e.response, 'text'):
+            if self.debug_mode and isinstance(e, httpx.HTTPStatusError):
                 print(f"Error response: {e.response.text}")
             return None
+        except (ValueError, ijson.JSONError) as e:
+            print(f"Error parsing API response: {e}")
+            return None
 
-    def store_data(self, data):
+    async def store_data(self, data):
         """
         Store the daily data in InfluxDB if configured, overwriting existing data points
         """
@@ -128,68 +199,161 @@ class APIPoller:
             return
             
         try:
-            if 'data' not in data or 'daily_data' not in data['data']:
-                print("No daily data found in API response")
+            daily_data = self._get_daily_data(data)
+            if not daily_data:
                 return
 
-            daily_data = data['data']['daily_data']
+            bucket = self.influx_bucket
+            org = self.influx_org
+
+            lines = []
+            ts_list = []
             
             for date, metrics in daily_data.items():
-                timestamp = datetime.strptime(date, "%Y-%m-%d")
+                timestamp = _parse_ymd(date)
                 
-                # Delete existing data for this timestamp
-                start_time = timestamp
-                end_time = timestamp + timedelta(days=1)
-                self.delete_api.delete(
-                    start=start_time,
-                    stop=end_time,
+                # Format the line protocol directly rather than going through Point
+                line = _to_line_protocol(timestamp, metrics)
+                if line is None:
+                    # Skip dates with no non-null metrics, InfluxDB rejects fieldless points
+                    if self.debug_mode:
+                        print(f"No metrics to store for {date}")
+                    continue
+
+                lines.append(line)
+                ts_list.append(timestamp)
+                if self.debug_mode:
+                    print(f"Prepared data point for {date}")
+
+            if not lines:
+                print("No metrics to store in API response")
+                return
+
+            # Delete existing data with one call per run of consecutive dates being written,
+            # so dates skipped in between keep their existing data
+            for start, stop in _contiguous_day_ranges(ts_list):
+                await self.delete_api.delete(
+                    start=start,
+                    stop=stop,
                     predicate='_measurement="daily_metrics"',
-                    bucket=self.influx_bucket,
-                    org=self.influx_org
+                    bucket=bucket,
+                    org=org
                 )
                 
                 if self.debug_mode:
-                    print(f"Deleted existing data points for {date}")
-
-                # Create new point
-                point = Point("daily_metrics")\
-                    .time(timestamp)
-                
-                for metric_name, metric_value in metrics.items():
-                    if metric_value is not None:  # Skip null values
-                        point = point.field(metric_name, metric_value)
+                    print(f"Deleted existing data points from {start.date()} to {(stop - timedelta(days=1)).date()}")
 
-                self.write_api.write(bucket=self.influx_bucket, org=self.influx_org, record=point)
-                print(f"Successfully stored data point for {date}")
+            # Write all records from this response in a single request
+            await self.write_api.write(bucket=bucket, org=org, record=lines, write_precision=WritePrecision.S)
+            print(f"Stored {len(lines)} data points covering {min(ts_list).date()}..{max(ts_list).date()}")
                 
         except Exception as e:
             print(f"Error storing data in InfluxDB: {e}")
 
-    def run(self):
+    async def _writer_loop(self, data_queue):
         """
-        Run the polling loop
+        Drain polled responses from the queue into InfluxDB until a None sentinel arrives
+        """
+        while True:
+            data = await data_queue.get()
+            if data is None:
+                break
+            await self.store_data(data)
+
+    async def _run(self):
+        """
+        Run the polling loop on the event loop until SIGINT or SIGTERM
         """
         interval_seconds = int(os.environ.get('POLLING_INTERVAL', 60))
         
         print(f"Starting API polling every {interval_seconds} seconds...")
         print(f"Debug mode: {'ON' if self.debug_mode else 'OFF'}")
-        print(f"InfluxDB storage: {'ENABLED' if self.influx_client else 'DISABLED'}")
+        print(f"InfluxDB storage: {'ENABLED' if self.influx_enabled else 'DISABLED'}")
         
-        while True:
-            try:
-                data = self.poll_api()
+        # Stop cooperatively on SIGINT/SIGTERM so queued data is flushed before exiting
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        
+        async def wait(delay):
+            # Sleep for delay seconds, waking early if a stop is requested
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), timeout=max(0, delay))
+        
+        async with contextlib.AsyncExitStack() as stack:
+            # Persistent HTTP/2 client so the connection to the API is reused between polls
+            self.session = await stack.enter_async_context(httpx.AsyncClient(
+                http2=True,
+                headers=self.headers,
+                follow_redirects=True,
+                timeout=httpx.Timeout(15.0, connect=3.0),
+                limits=httpx.Limits(max_keepalive_connections=4)
+            ))
+            
+            # Store responses on a writer task so InfluxDB latency doesn't delay polling
+            data_queue = asyncio.Queue(maxsize=8)
+            writer = None
+            if self.influx_enabled:
+                self.influx_client = await stack.enter_async_context(InfluxDBClientAsync(
+                    url=self.influx_url,
+                    token=self.influx_token,
+                    org=self.influx_org
+                ))
+                self.write_api = self.influx_client.write_api()
                 
-                if data and self.influx_client:
-                    self.store_data(data)
+                # Delete API for handling overwrites
+                self.delete_api = self.influx_client.delete_api()
+                writer = asyncio.create_task(self._writer_loop(data_queue))
+            
+            # Schedule polls on a fixed monotonic cadence so poll duration doesn't cause drift
+            next_tick = time.monotonic()
+            
+            # Back off exponentially (capped, with jitter) while polls keep failing
+            backoff = interval_seconds
+            max_backoff = max(600, interval_seconds)
+            
+            while not stop.is_set():
+                data = None
+                try:
+                    data = await self.poll_api()
+                    
+                    if data and writer:
+                        try:
+                            await asyncio.wait_for(data_queue.put(data), timeout=interval_seconds)
+                        except asyncio.TimeoutError:
+                            print("InfluxDB writer is falling behind - dropping polled data")
+                    
+                except Exception as e:
+                    print(f"Unexpected error: {e}")
                 
-                time.sleep(interval_seconds)
+                if data is None:
+                    delay = min(backoff, max_backoff)
+                    delay += random.uniform(0, delay * 0.1)
+                    backoff *= 2
+                    print(f"Retrying in {delay:.0f} seconds...")
+                    await wait(delay)
+                    next_tick = time.monotonic()
+                    continue
+                backoff = interval_seconds
                 
-            except KeyboardInterrupt:
-                print("\nStopping API polling...")
-                break
-            except Exception as e:
-                print(f"Unexpected error: {e}")
-                time.sleep(interval_seconds)
+                next_tick += interval_seconds
+                now = time.monotonic()
+                if now > next_tick:
+                    # Skip ticks missed during a long poll or outage instead of firing them back to back
+                    next_tick += ((now - next_tick) // interval_seconds + 1) * interval_seconds
+                await wait(next_tick - now)
+            
+            print("\nStopping API polling...")
+            if writer:
+                await data_queue.put(None)
+                await writer
+
+    def run(self):
+        """
+        Run the polling loop
+        """
+        asyncio.run(self._run())
 
 if __name__ == "__main__":
     poller = APIPoller()